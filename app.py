@@ -1,13 +1,26 @@
 import os
-import math
-import json
-import datetime
+import sys
+from decimal import Decimal
 import time
+import random
+import functools
 import threading
-from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import collections
+from typing import NamedTuple
+try: import fcntl
+except ImportError: fcntl = None
+import orjson
+from flask import Flask, request
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
 from binance.spot import Spot
-from binance.error import ClientError
+from binance.error import ClientError, ServerError
+from binance.websocket.spot.websocket_stream import SpotWebsocketStreamClient
 import gspread
+from google.oauth2.service_account import Credentials
 
 app = Flask(__name__)
 
@@ -16,157 +29,541 @@ API_KEY = os.environ.get('BINANCE_API_KEY')
 API_SECRET = os.environ.get('BINANCE_API_SECRET')
 WEBHOOK_PASSPHRASE = os.environ.get('WEBHOOK_PASSPHRASE')
 BASE_URL = 'https://testnet.binance.vision'
+STREAM_URL = 'wss://testnet.binance.vision'
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 GOOGLE_JSON = os.environ.get('GOOGLE_CREDENTIALS')
+# Opening by key skips the Drive search that open("TradingBotLog") does
+SPREADSHEET_ID = os.environ.get('SPREADSHEET_ID')
+GOOGLE_INFO = orjson.loads(GOOGLE_JSON) if GOOGLE_JSON else None
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive"
 ]
 
-client = Spot(api_key=API_KEY, api_secret=API_SECRET, base_url=BASE_URL)
+# (connect, read) timeout caps how long a webhook can hang on Binance
+client = Spot(api_key=API_KEY, api_secret=API_SECRET, base_url=BASE_URL, timeout=(3, 10))
+# Reuse TLS connections to Binance instead of handshaking per call.
+# urllib3 only retries idempotent methods by default, so new_order (POST) is never resent.
+# Server errors only: a 429/418 goes straight back to the caller, and Retry-After is
+# ignored so a throttled GET can't stall a webhook for Binance's full back-off.
+BINANCE_RETRY = Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504],
+                      respect_retry_after_header=False)
+client.session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20,
+                                             pool_block=False, max_retries=BINANCE_RETRY))
+PING_INTERVAL = 30
+SYNC_INTERVAL = 15
+# Unchanged dashboard values are still rewritten this often so A2's timestamp shows liveness
+DASHBOARD_HEARTBEAT = 300
+# Gateway hiccups only; 429s are paced by SHEETS and the logger's back-off
+SHEETS_RETRY = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
 GOOGLE_CLIENT = None
+GOOGLE_CREDS = None
+# worksheet name -> Worksheet, so the Drive lookup runs once per process
+_WS_CACHE = {}
+
+# Quote assets, longest first so FDUSD wins over USD-suffixed lookalikes
+QUOTE_ASSETS = ('FDUSD', 'BUSD', 'USDT', 'USDC', 'TUSD', 'BTC', 'ETH', 'BNB')
 
 # --- IN-MEMORY CACHE (Settings Only) ---
-BOT_MEMORY = {
-    "e2_pct": 100.0,
-    "f2_type": "MARKET",
-    "j2_slip": 0.0
-}
+class BotMemory(NamedTuple):
+    """Sheet settings read on every webhook. Immutable: writers publish a new
+    snapshot by rebinding BOT_MEMORY under MEM_WRITE_LOCK, readers need no lock"""
+    e2_pct: float = 100.0
+    f2_type: str = "MARKET"
+    j2_slip: float = 0.0
+    monitor_asset: str = ""
+
+BOT_MEMORY = BotMemory()
+# Serialises writers so a _replace() never builds on a snapshot that's being superseded
+MEM_WRITE_LOCK = threading.Lock()
 
 # --- LOGGING QUEUE ---
-LOG_QUEUE = []
+# Bounded so a long Sheets outage can't grow memory without limit
+LOG_QUEUE = queue.Queue(maxsize=1000)
+LOG_BATCH_MAX = 50
+LOG_BACKOFF_CAP = 60
+LOG_DROPPED = 0
+# Sheets 429s seen by retry_with_backoff, reported by debug_memory
+THROTTLED = 0
 
 # --- THREAD CONTROL ---
-THREADS = { "logger": None, "sync": None }
+THREADS = { "logger": None, "sync": None, "ping": None, "stream": None }
+
+# Overlaps independent Binance lookups inside a single webhook
+IO_POOL = ThreadPoolExecutor(max_workers=4)
+# Places TradingView alerts after the 202; one worker keeps signals in arrival order
+TRADE_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix='trade')
+
+# --- DASHBOARD OWNERSHIP (one process per host polls/writes the dashboard) ---
+DASHBOARD_LOCK_PATH = os.environ.get('DASHBOARD_LOCK', '/tmp/tradingbot_dashboard.lock')
+_DASHBOARD_LOCK = None
+
+# --- LIVE STREAM CACHE (pushed by Binance websockets) ---
+STREAM = {"live": False, "balances": {}, "locked": {}, "prices": {}}
+LISTEN_KEY_RENEW = 1800
+
+# --- EXCHANGE METADATA CACHE ---
+# symbol -> ({filterType: filter}, fetched_at). Filters rarely change, refresh daily.
+_FILTERS = {}
+FILTER_CACHE_TTL = 86400
+# symbol -> baseAsset from the same exchange_info payloads
+_BASE_ASSETS = {}
+# Serialises exchange_info fetches so concurrent misses share one call
+_FILTER_LOCK = threading.Lock()
+MIN_ORDER_USDT = 10.0
+# What a failed Binance REST lookup can raise (malformed payloads included)
+BINANCE_ERRORS = (ClientError, ServerError, RequestException, KeyError, ValueError)
+# Seconds a webhook may spend retrying balance reads before giving up
+BALANCE_DEADLINE = 2.5
+# Last account() snapshot: 'all' -> (monotonic ts, {asset: free})
+_BAL_CACHE = {}
+BAL_CACHE_TTL = 1.5
+# step/tick string -> (Decimal step, decimal places)
+_STEP_PARAMS = {}
+
+# --- SHEETS RATE LIMIT ---
+def retry_with_backoff(max_tries=5, base=0.25, cap=8.0):
+    """Retries Sheets calls rejected with 429: base*2^n (+jitter) capped at `cap`,
+    or Retry-After if longer. A Retry-After beyond the cap raises at once"""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            global THROTTLED
+            for n in range(max_tries):
+                try:
+                    return fn(*args, **kwargs)
+                except gspread.exceptions.APIError as e:
+                    resp = getattr(e, 'response', None)
+                    if getattr(resp, 'status_code', None) != 429 or n == max_tries - 1: raise
+                    THROTTLED += 1
+                    wait = safe_float(resp.headers.get('Retry-After'))
+                    if wait > cap: raise
+                    time.sleep(max(wait, min(cap, base * 2 ** n) + random.random() * 0.25))
+        return inner
+    return wrap
+
+class SheetsLimiter:
+    """Serialises Sheets calls from all threads and paces them under the quota"""
+    def __init__(self, max_calls=55, period=60.0):
+        self.lock = threading.Lock()
+        self.calls = collections.deque()
+        self.max_calls = max_calls
+        self.period = period
+
+    # 429 only: a 5xx append may already have landed, resending would duplicate rows
+    @retry_with_backoff()
+    def call(self, fn, *args, **kwargs):
+        with self.lock:
+            now = time.monotonic()
+            while self.calls and now - self.calls[0] > self.period: self.calls.popleft()
+            if len(self.calls) >= self.max_calls:
+                time.sleep(max(0.0, self.period - (now - self.calls[0])))
+                self.calls.popleft()
+            self.calls.append(time.monotonic())
+            return fn(*args, **kwargs)
+
+# Sheets allows 60 reads and 60 writes per minute per user; stay just under
+SHEETS = SheetsLimiter()
 
 # --- HELPERS ---
+_NUM_JUNK = str.maketrans('', '', '$, ')
+
 def safe_float(value, default=0.0):
+    if type(value) is float: return value
+    if type(value) is int: return float(value)
     try:
         if isinstance(value, str):
-            clean = value.replace('$', '').replace(',', '').replace(' ', '').strip()
+            # One translate pass drops '$', ',' and spaces
+            clean = value.translate(_NUM_JUNK).strip()
             if clean == "": return default
             return float(clean)
         return float(value)
-    except: return default
+    except (TypeError, ValueError): return default
+
+def is_dashboard_owner():
+    """True in exactly one process: the one holding the dashboard lock file"""
+    global _DASHBOARD_LOCK
+    if _DASHBOARD_LOCK is not None or fcntl is None: return True
+    try: fd = open(DASHBOARD_LOCK_PATH, 'w')
+    except OSError: return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fd.close()
+        return False
+    # Kept open for the life of the process; the OS releases it on exit
+    _DASHBOARD_LOCK = fd
+    return True
+
+def json_response(obj):
+    """orjson-encoded JSON response (Flask's jsonify goes through stdlib json)"""
+    return app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+def read_json():
+    # Parsed once; no need for Flask to keep a second copy of the body
+    try: return orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError: return None
 
 def get_sheet():
+    global GOOGLE_CLIENT, GOOGLE_CREDS
+    ws = _WS_CACHE.get("Dashboard")
+    if ws is not None: return ws
+    if GOOGLE_CLIENT is None:
+        # Key parsing happens once; reconnects reuse the credentials
+        if GOOGLE_CREDS is None:
+            GOOGLE_CREDS = Credentials.from_service_account_info(GOOGLE_INFO, scopes=SCOPES)
+        GOOGLE_CLIENT = gspread.authorize(GOOGLE_CREDS)
+        # gspread 6 keeps its AuthorizedSession on http_client, 5.x on the client
+        http = getattr(GOOGLE_CLIENT, 'http_client', GOOGLE_CLIENT)
+        http.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                                   max_retries=SHEETS_RETRY))
+    if SPREADSHEET_ID: spreadsheet = SHEETS.call(GOOGLE_CLIENT.open_by_key, SPREADSHEET_ID)
+    else: spreadsheet = SHEETS.call(GOOGLE_CLIENT.open, "TradingBotLog")
+    ws = SHEETS.call(spreadsheet.worksheet, "Dashboard")
+    _WS_CACHE["Dashboard"] = ws
+    return ws
+
+def reset_sheet():
+    """Drop cached handles so the next get_sheet() reconnects"""
     global GOOGLE_CLIENT
-    try:
-        if GOOGLE_CLIENT is None:
-            creds = json.loads(GOOGLE_JSON)
-            GOOGLE_CLIENT = gspread.service_account_from_dict(creds, scopes=SCOPES)
-        return GOOGLE_CLIENT.open("TradingBotLog").worksheet("Dashboard")
-    except Exception:
-        creds = json.loads(GOOGLE_JSON)
-        GOOGLE_CLIENT = gspread.service_account_from_dict(creds, scopes=SCOPES)
-        return GOOGLE_CLIENT.open("TradingBotLog").worksheet("Dashboard")
-
-def get_balance(asset):
-    """Robust balance checker"""
-    for attempt in range(3):
+    _WS_CACHE.clear()
+    GOOGLE_CLIENT = None
+
+def split_symbol(symbol):
+    """'BTCUSDT' -> ('BTC', 'USDT'). Pairs only: a bare 'WBTC' would split as ('W', 'BTC')"""
+    quote = next((q for q in QUOTE_ASSETS if symbol.endswith(q) and len(symbol) > len(q)), None)
+    return (symbol[:-len(quote)], quote) if quote else (symbol, None)
+
+def monitor_asset_of(raw):
+    """H1 holds a pair or a bare asset; only pairs Binance lists are split, else a USDT suffix is dropped"""
+    base = _BASE_ASSETS.get(raw)
+    if base: return base
+    return raw[:-len("USDT")] if raw.endswith("USDT") and len(raw) > len("USDT") else raw
+
+def get_balance_map(deadline=None):
+    """Free balance per asset from a single account() call.
+    Retries back off 0.1s, 0.2s, 0.4s... and stop at the monotonic deadline"""
+    if deadline is None: deadline = time.monotonic() + BALANCE_DEADLINE
+    delay = 0.1
+    while True:
         try:
             acct = client.account()
-            for a in acct['balances']:
-                if a['asset'] == asset: return float(a['free'])
-            return 0.0
-        except: time.sleep(0.5)
-    return 0.0
+            bals = {a['asset']: float(a['free']) for a in acct['balances']}
+            _BAL_CACHE['all'] = (time.monotonic(), bals)
+            return bals
+        except BINANCE_ERRORS:
+            if time.monotonic() + delay >= deadline: return {}
+            time.sleep(delay)
+            delay *= 2
+
+def get_balance(asset, fresh=False):
+    """Robust balance checker. fresh=True skips the stream cache"""
+    if not fresh and STREAM["live"]:
+        return STREAM["balances"].get(asset, 0.0)
+    hit = _BAL_CACHE.get('all')
+    if not fresh and hit and time.monotonic() - hit[0] < BAL_CACHE_TTL:
+        return hit[1].get(asset, 0.0)
+    return get_balance_map().get(asset, 0.0)
+
+def held_balance(asset):
+    """Free + locked from the stream (None if it's down): the most a cancel can free up"""
+    if not STREAM["live"]: return None
+    return STREAM["balances"].get(asset, 0.0) + STREAM["locked"].get(asset, 0.0)
+
+def balances_after_order(bals, resp, base, quote):
+    """Free balances after new_order, derived from its response instead of account()"""
+    after = dict(bals)
+    exec_qty = safe_float(resp.get('executedQty'))
+    orig_qty = safe_float(resp.get('origQty'))
+    quote_qty = safe_float(resp.get('cummulativeQuoteQty'))
+    if resp.get('side') == 'BUY':
+        # An unfilled LIMIT remainder is locked, so it leaves the free balance too
+        locked = (orig_qty - exec_qty) * safe_float(resp.get('price'))
+        after[quote] = after.get(quote, 0.0) - quote_qty - locked
+        after[base] = after.get(base, 0.0) + exec_qty
+    else:
+        after[base] = after.get(base, 0.0) - orig_qty
+        after[quote] = after.get(quote, 0.0) + quote_qty
+    for f in resp.get('fills', []):
+        asset = f['commissionAsset']
+        after[asset] = after.get(asset, 0.0) - safe_float(f['commission'])
+    return after
 
 def cancel_all_open_orders(symbol):
+    """One DELETE; Binance answers -2011 when there was nothing to cancel"""
     try:
-        open_orders = client.get_open_orders(symbol)
-        if open_orders:
-            client.cancel_open_orders(symbol)
-            return True
-    except: pass
+        client.cancel_open_orders(symbol)
+        return True
+    except ClientError as e:
+        if e.error_code != -2011: print(f"Cancel Error {symbol}: {e.error_message}")
+    except BINANCE_ERRORS: pass
     return False
 
 def get_coin_price(symbol):
+    if STREAM["live"] and symbol in STREAM["prices"]:
+        return STREAM["prices"][symbol]
     try:
         return float(client.ticker_price(symbol=symbol)['price'])
-    except: return 0.0
+    except BINANCE_ERRORS: return 0.0
 
-def get_symbol_step_size(symbol):
+def cache_filters(symbols):
+    now = time.time()
+    for s in symbols:
+        _FILTERS[s['symbol']] = ({f['filterType']: f for f in s['filters']}, now)
+        _BASE_ASSETS[s['symbol']] = s['baseAsset']
+
+def warm_filter_cache():
+    """One exchange_info() call fills the filter cache for every pair"""
     try:
-        info = client.exchange_info(symbol=symbol)
-        for f in info['symbols'][0]['filters']:
-            if f['filterType'] == 'LOT_SIZE': return f['stepSize']
-    except: pass
-    return '0.00001'
+        with _FILTER_LOCK: cache_filters(client.exchange_info()['symbols'])
+        print(f"Filter cache warmed: {len(_FILTERS)} symbols")
+    except Exception as e:
+        print(f"Filter cache warm failed: {e}")
+
+def cached_filters(symbol):
+    hit = _FILTERS.get(symbol)
+    if hit and time.time() - hit[1] < FILTER_CACHE_TTL: return hit[0]
+    return None
+
+def get_symbol_filters(symbol):
+    hit = cached_filters(symbol)
+    if hit is not None: return hit
+    with _FILTER_LOCK:
+        # Another thread (or the startup warm) may have filled it while we waited
+        hit = cached_filters(symbol)
+        if hit is not None: return hit
+        try:
+            cache_filters(client.exchange_info(symbol=symbol)['symbols'])
+            return _FILTERS[symbol][0]
+        except BINANCE_ERRORS: pass
+    return {}
+
+def get_symbol_step_size(symbol):
+    f = get_symbol_filters(symbol).get('LOT_SIZE')
+    return f['stepSize'] if f else '0.00001'
 
 def get_price_tick_size(symbol):
-    try:
-        info = client.exchange_info(symbol=symbol)
-        for f in info['symbols'][0]['filters']:
-            if f['filterType'] == 'PRICE_FILTER': return f['tickSize']
-    except: pass
-    return '0.000001'
+    f = get_symbol_filters(symbol).get('PRICE_FILTER')
+    return f['tickSize'] if f else '0.000001'
+
+def get_min_notional(symbol):
+    """Exchange minimum order value, MIN_ORDER_USDT if unknown"""
+    filters = get_symbol_filters(symbol)
+    f = filters.get('NOTIONAL') or filters.get('MIN_NOTIONAL')
+    return safe_float(f.get('minNotional'), MIN_ORDER_USDT) if f else MIN_ORDER_USDT
+
+def step_params(step_size):
+    """'0.00100000' -> (Decimal('0.001'), 3), parsed once per distinct step string"""
+    hit = _STEP_PARAMS.get(step_size)
+    if hit: return hit
+    s = str(step_size)
+    if '.' in s: s = s.rstrip('0').rstrip('.')
+    precision = len(s.split('.')[1]) if '.' in s else 0
+    hit = _STEP_PARAMS[step_size] = (Decimal(s), precision)
+    return hit
 
 def round_step_size(quantity, step_size):
-    precision = int(round(-math.log(float(step_size), 10), 0))
-    return float(round(quantity - (quantity % float(step_size)), precision))
+    """Floor quantity to a multiple of step_size, exact in decimal (no float modulo)"""
+    step, _ = step_params(step_size)
+    return float((Decimal(str(quantity)) // step) * step)
+
+def format_price(price, tick_size):
+    """Price string with exactly the tick's decimal places"""
+    return format(price, f".{step_params(tick_size)[1]}f")
+
+def queue_log(task):
+    """Non-blocking enqueue; when full, the oldest entry makes room"""
+    global LOG_DROPPED
+    while True:
+        try:
+            LOG_QUEUE.put_nowait(task)
+            return
+        except queue.Full:
+            try:
+                LOG_QUEUE.get_nowait()
+                LOG_DROPPED += 1
+                print(f"WARN: log queue full, dropped {LOG_DROPPED} entries so far", file=sys.stderr)
+            except queue.Empty: pass
+
+def limit_price(symbol, side, raw_price, slip_pct):
+    """Slippage-adjusted LIMIT price floored to the tick -> (float, str)"""
+    sign = 1 if side == 'BUY' else -1
+    tick_size = get_price_tick_size(symbol)
+    final_lim = round_step_size(raw_price * (1 + sign * slip_pct / 100.0), tick_size)
+    return final_lim, format_price(final_lim, tick_size)
 
 # --- WORKER FUNCTIONS ---
+def append_log_rows(sheet, rows):
+    """append_rows for a batch -> rows still to send after a throttle/server error.
+    A batch Sheets rejects as invalid (400) is halved until the bad row is dropped"""
+    chunks = [rows]
+    while chunks:
+        chunk = chunks.pop(0)
+        try:
+            SHEETS.call(sheet.append_rows, chunk, value_input_option='RAW', table_range='A6:K6')
+        except gspread.exceptions.APIError as e:
+            if getattr(e.response, 'status_code', None) != 400:
+                return chunk + [r for c in chunks for r in c]
+            if len(chunk) == 1:
+                print(f"Logger dropped row {chunk[0]}: {e}")
+                continue
+            mid = len(chunk) // 2
+            chunks[:0] = [chunk[:mid], chunk[mid:]]
+    return []
+
 def logger_worker_func():
-    global LOG_QUEUE
     print("Logger Thread Started")
+    pending = []
+    attempt = 0
     while True:
-        if len(LOG_QUEUE) > 0:
-            task_type, data = LOG_QUEUE[0]
-            try:
-                sheet = get_sheet()
-                # We only log rows now, no state updates
-                if task_type == 'LOG':
-                    col_a = sheet.col_values(1)
-                    next_row = len(col_a) + 1
-                    if next_row < 6: next_row = 6
-                    sheet.update(f'A{next_row}:K{next_row}', [data])
-                LOG_QUEUE.pop(0)
-            except Exception as e:
-                print(f"Logger Retrying: {e}")
-                time.sleep(5)
-        time.sleep(1)
+        # Block until work arrives, then drain whatever else is queued
+        if not pending: pending.append(LOG_QUEUE.get())
+        while len(pending) < LOG_BATCH_MAX:
+            try: pending.append(LOG_QUEUE.get_nowait())
+            except queue.Empty: break
+        try:
+            sheet = get_sheet()
+            rows = [data for task_type, data in pending if task_type == 'LOG']
+            left = append_log_rows(sheet, rows) if rows else []
+            # Rows already appended are never re-sent
+            pending = [t for t in pending if t[0] != 'LOG'] + [('LOG', r) for r in left]
+            if not left:
+                # I2 holds one balance, so only the latest refresh in the batch matters
+                refresh = [data for task_type, data in pending if task_type == 'H2_REFRESH']
+                if refresh:
+                    SHEETS.call(sheet.update, 'I2', [[get_balance(refresh[-1], fresh=True)]])
+                pending = []
+                attempt = 0
+                continue
+            print(f"Logger: Sheets throttled, {len(left)} rows pending")
+        except gspread.exceptions.APIError as e:
+            print(f"Logger Retrying: {e}")
+        except Exception as e:
+            print(f"Logger Retrying: {e}")
+            reset_sheet()
+        # Exponential back-off with jitter so retries don't land in lockstep
+        attempt += 1
+        time.sleep(min(LOG_BACKOFF_CAP, 2 ** attempt) + random.random())
+
+def load_settings(sheet):
+    """Reads E2, G2, K2 and I1 in one batch_get into BOT_MEMORY"""
+    global BOT_MEMORY
+    data = SHEETS.call(sheet.batch_get, ['E2', 'G2', 'K2', 'I1'])
+    
+    val_e2 = safe_float(data[0][0][0] if (len(data) > 0 and data[0]) else 100)
+    val_f2 = str(data[1][0][0]).upper() if (len(data) > 1 and data[1]) else "MARKET"
+    raw_slip = str(data[2][0][0]) if (len(data) > 2 and data[2]) else "0"
+    val_j2 = safe_float(raw_slip.replace("%", ""))
+    raw_mon = str(data[3][0][0]).strip().upper() if (len(data) > 3 and data[3]) else ""
+
+    val_mon = monitor_asset_of(raw_mon) if raw_mon else ""
+
+    # One rebind: readers see the old set or the new one, never a mix
+    with MEM_WRITE_LOCK: BOT_MEMORY = BotMemory(val_e2, val_f2, val_j2, val_mon)
 
 def background_sync_func():
     """Syncs settings (E2, F2, J2) and Updates Dashboard"""
-    global BOT_MEMORY
-    time.sleep(2) 
+    # Settings load on the first tick straight away; filters warm alongside
+    IO_POOL.submit(warm_filter_cache)
     tick = 0 
+    last_dash, last_dash_at = None, 0.0
+    next_tick = time.monotonic()
     while True:
         try:
             sheet = get_sheet()
             # Task A: Sync Settings (Ignore D2)
-            data = sheet.batch_get(['E2', 'G2', 'K2'])
-            
-            val_e2 = safe_float(data[0][0][0] if (len(data) > 0 and data[0]) else 100)
-            val_f2 = str(data[1][0][0]).upper() if (len(data) > 1 and data[1]) else "MARKET"
-            raw_slip = str(data[2][0][0]) if (len(data) > 2 and data[2]) else "0"
-            val_j2 = safe_float(raw_slip.replace("%", ""))
+            load_settings(sheet)
 
-            BOT_MEMORY['e2_pct'] = val_e2
-            BOT_MEMORY['f2_type'] = val_f2
-            BOT_MEMORY['j2_slip'] = val_j2
-
-            # Task B: Dashboard
-            if tick % 4 == 0: 
+            # Task B: Dashboard (settings above are per-process, this is not)
+            if tick % 4 == 0 and is_dashboard_owner():
                 try:
+                    # Price and balances are independent lookups; overlap them when
+                    # they fall back to REST. The coin balance reuses USDT's snapshot
+                    btc_f = IO_POOL.submit(get_coin_price, "BTCUSDT")
                     usdt = get_balance("USDT")
-                    btc = get_coin_price("BTCUSDT")
-                    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    sheet.update('A2:C2', [[ts, usdt, btc]])
+                    btc = btc_f.result()
+                    mon_sym = BOT_MEMORY.monitor_asset
+                    c_bal = get_balance(mon_sym) if mon_sym else None
                     
-                    h1_val = sheet.acell('I1').value
-                    if h1_val:
-                        mon_sym = h1_val.replace("USDT","").strip().upper()
-                        c_bal = get_balance(mon_sym)
-                        sheet.update('I2', [[c_bal]])
-                except: pass
+                    # Nothing moved: skip the write until the heartbeat is due
+                    values = (usdt, btc, mon_sym, c_bal)
+                    now = time.monotonic()
+                    if values != last_dash or now - last_dash_at >= DASHBOARD_HEARTBEAT:
+                        ts = time.strftime(TS_FORMAT)
+                        updates = [{'range': 'A2:C2', 'values': [[ts, usdt, btc]]}]
+                        if mon_sym: updates.append({'range': 'I2', 'values': [[c_bal]]})
+                        SHEETS.call(sheet.batch_update, updates, value_input_option='RAW')
+                        last_dash, last_dash_at = values, now
+                except Exception as e: print(f"Dashboard Error: {e}")
         except Exception as e:
             print(f"Sync Error: {e}")
+            reset_sheet()
             time.sleep(60)
         
         tick += 1
-        time.sleep(15)
+        # Fixed cadence: a slow tick shortens the wait instead of drifting the schedule
+        next_tick = max(next_tick + SYNC_INTERVAL, time.monotonic())
+        time.sleep(max(0.0, next_tick - time.monotonic()))
+
+def on_stream_message(_, message):
+    try: msg = orjson.loads(message)
+    except ValueError: return
+    if not isinstance(msg, dict): return
+    event = msg.get('e')
+    if event == 'outboundAccountPosition':
+        for b in msg['B']:
+            STREAM["balances"][b['a']] = float(b['f'])
+            STREAM["locked"][b['a']] = float(b['l'])
+    elif event == '24hrMiniTicker':
+        STREAM["prices"][msg['s']] = float(msg['c'])
+
+def on_stream_close(_):
+    STREAM["live"] = False
+
+def on_stream_error(_, error):
+    print(f"Stream Error: {error}")
+    STREAM["live"] = False
+
+def stream_worker_func():
+    """Mirrors balances and BTC price from websockets instead of REST polling"""
+    print("Stream Thread Started")
+    while True:
+        ws = None
+        try:
+            listen_key = client.new_listen_key()['listenKey']
+            ws = SpotWebsocketStreamClient(stream_url=STREAM_URL, on_message=on_stream_message,
+                                           on_close=on_stream_close, on_error=on_stream_error)
+            ws.user_data(listen_key=listen_key)
+            ws.mini_ticker(symbol='btcusdt')
+            # Seed once over REST, the stream only pushes changed assets
+            acct = client.account()
+            STREAM["balances"] = {a['asset']: float(a['free']) for a in acct['balances']}
+            STREAM["locked"] = {a['asset']: float(a['locked']) for a in acct['balances']}
+            STREAM["live"] = True
+            renewed = time.time()
+            while STREAM["live"]:
+                time.sleep(5)
+                if time.time() - renewed > LISTEN_KEY_RENEW:
+                    client.renew_listen_key(listen_key)
+                    renewed = time.time()
+        except Exception as e:
+            print(f"Stream Error: {e}")
+        STREAM["live"] = False
+        if ws:
+            try: ws.stop()
+            except Exception: pass
+        time.sleep(10)
+
+def keepalive_func():
+    """Pings Binance so the pooled connection stays warm, and restarts dead workers"""
+    while True:
+        try: client.ping()
+        except Exception as e: print(f"Ping Error: {e}")
+        # Guarded separately: this thread is the only watchdog, so it must not die
+        try: ensure_threads_running()
+        except Exception as e: print(f"Watchdog Error: {e}")
+        time.sleep(PING_INTERVAL)
 
 def ensure_threads_running():
     global THREADS
@@ -178,28 +575,63 @@ def ensure_threads_running():
         print("Starting Sync Thread...")
         THREADS["sync"] = threading.Thread(target=background_sync_func, daemon=True)
         THREADS["sync"].start()
-
+    if (THREADS["stream"] is None or not THREADS["stream"].is_alive()) and is_dashboard_owner():
+        THREADS["stream"] = threading.Thread(target=stream_worker_func, daemon=True)
+        THREADS["stream"].start()
+    if THREADS["ping"] is None or not THREADS["ping"].is_alive():
+        THREADS["ping"] = threading.Thread(target=keepalive_func, daemon=True)
+        THREADS["ping"].start()
+
+# Once per process (gunicorn.conf.py refuses preload_app); the ping thread
+# re-runs this every PING_INTERVAL so a dead logger/sync thread comes back
 ensure_threads_running()
 
 # --- ROUTES ---
 @app.route('/')
 def home():
-    ensure_threads_running() 
     return "Bot is awake.", 200
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    ensure_threads_running()
-    
-    data = request.get_json(force=True)
-    if data.get('passphrase') != WEBHOOK_PASSPHRASE: return jsonify({"error": "Unauthorized"}), 401
+    data = read_json()
+    if not isinstance(data, dict): return json_response({"error": "Invalid JSON"}), 400
+    if data.get('passphrase') != WEBHOOK_PASSPHRASE: return json_response({"error": "Unauthorized"}), 401
     
     raw_s = data['symbol'].upper().replace("/", "")
-    symbol = raw_s + "T" if raw_s.endswith("USD") and not raw_s.endswith("USDT") else raw_s
-    market_price = get_coin_price(symbol)
-    side = data['side'].upper()
+    # TradingView's BTCUSD means BTCUSDT; BUSD/TUSD/FDUSD are real quotes
+    symbol = raw_s + "T" if raw_s.endswith("USD") and not raw_s.endswith(QUOTE_ASSETS) else raw_s
+    if not symbol.endswith(QUOTE_ASSETS):
+        return json_response({"error": f"Unsupported symbol {symbol}"}), 400
+    side = str(data.get('side', '')).upper()
+    if side not in ('BUY', 'SELL'):
+        return json_response({"error": "side must be BUY or SELL"}), 400
+    data['side'] = side  # normalised once here; process_trade reads it as-is
+    data['reason'] = str(data.get('reason') or '')
+    
+    # Every trade goes through TRADE_POOL so none overlaps another. commander.py
+    # prints the order result, so manual trades wait for theirs; TradingView only
+    # needs an ack and its alerts are placed in the background.
+    if "CLI" in data['reason']:
+        resp, code = TRADE_POOL.submit(process_trade, data, symbol).result()
+        return json_response(resp), code
+    TRADE_POOL.submit(process_trade, data, symbol).add_done_callback(report_trade_failure)
+    return json_response({"status": "accepted", "symbol": symbol}), 202
+
+def report_trade_failure(future):
+    """Nobody waits on background TRADE_POOL futures, so print what process_trade let escape"""
+    e = future.exception()
+    if e is not None: print(f"Trade Error: {e!r}", file=sys.stderr)
+
+def process_trade(data, symbol):
+    """Places the order for one signal and queues its log row -> (response, http status)"""
+    # Independent of the cancel/balance sequence below, so run them alongside it
+    price_f = IO_POOL.submit(get_coin_price, symbol)
+    filters_f = IO_POOL.submit(get_symbol_filters, symbol)
+    side = data['side']
     sent_price = data.get('price', 'Market')
-    reason = data.get('reason', '') 
+    reason = data['reason']
+    ts = time.strftime(TS_FORMAT)  # one timestamp for every row this signal writes
+    deadline = time.monotonic() + BALANCE_DEADLINE
     
     status = "Pending"
     exec_price = 0
@@ -208,24 +640,38 @@ def webhook():
     final_cap = 0
     req_pct = 0
     
-    # Init sheet for fallback
-    try: sheet = get_sheet()
-    except: sheet = None
-
 
     try:
-        # 1. READ SETTINGS
-        e2_pct = BOT_MEMORY['e2_pct']
-        f2_type = BOT_MEMORY['f2_type']
-        j2_slip = BOT_MEMORY['j2_slip']
+        # 1. READ SETTINGS (one consistent snapshot, even mid-sync)
+        mem = BOT_MEMORY
+        e2_pct, f2_type, j2_slip = mem.e2_pct, mem.f2_type, mem.j2_slip
         
         # 2. CHECK COIN HOLDINGS & CANCEL
-        base_asset = symbol.replace("USDT","")
+        base_asset, quote_asset = split_symbol(symbol)
         cancel_all_open_orders(symbol)
-        
-        # Get fresh balances AFTER cancel
-        coin_bal = get_balance(base_asset)
-        wallet_usdt = get_balance("USDT")
+
+        # A BUY that stays under the minimum even if the cancel freed every locked
+        # quote can only be skipped, so it doesn't need a fresh account() read
+        max_amt = None
+        held = held_balance(quote_asset) if side == 'BUY' else None
+        if held is not None:
+            try: pct = float(data.get('PercentAmount', data.get('percentage', e2_pct)))
+            except (TypeError, ValueError): pct = None
+            if pct is not None:
+                filters_f.result()
+                upper = held * min(pct, 100.0) / 100.0
+                if upper <= get_min_notional(symbol): max_amt = upper
+
+        if max_amt is not None:
+            bals = dict(STREAM["balances"])
+        else:
+            # Get fresh balances AFTER cancel (one account() call)
+            bals = get_balance_map(deadline)
+        coin_bal = bals.get(base_asset, 0.0)
+        # BUYs spend the pair's quote, which quoteOrderQty and NOTIONAL are priced in
+        wallet_quote = bals.get(quote_asset, 0.0)
+        # Step/tick lookups below are cache hits once this resolves
+        filters_f.result()
         
         # 3. ORDER TYPE LOGIC
         payload_type = data.get('type', 'MARKET').upper()
@@ -250,18 +696,15 @@ def webhook():
                 
                 # SAFETY BUFFER: If buying 100%, use 99.9% to avoid "Insufficient Balance"
                 if req_pct >= 99.9:
-                    amt = wallet_usdt * 0.999
+                    amt = wallet_quote * 0.999
                 else:
-                    amt = wallet_usdt * (req_pct / 100.0)
+                    amt = wallet_quote * (req_pct / 100.0)
                 
                 params = {"symbol": symbol, "side": "BUY", "type": target_type}
                 
                 if target_type == 'LIMIT':
                     raw_price = float(data.get('limit_price', sent_price))
-                    adj_price = raw_price * (1 + (j2_slip / 100.0))
-                    
-                    tick_size = get_price_tick_size(symbol)
-                    final_lim = round_step_size(adj_price, tick_size)
+                    final_lim, price_str = limit_price(symbol, 'BUY', raw_price, j2_slip)
                     
                     qty_coins = amt / final_lim 
                     step = get_symbol_step_size(symbol)
@@ -269,16 +712,22 @@ def webhook():
                     
                     params['timeInForce'] = data.get('timeInForce', 'GTC')
                     params['quantity'] = qty_coins
-                    params['price'] = "{:.8f}".format(final_lim).rstrip('0').rstrip('.')
+                    params['price'] = price_str
                     amt = qty_coins * final_lim 
                 else:
                     params['quoteOrderQty'] = round(amt, 2)
 
-                if amt > 10:
+                min_amt = get_min_notional(symbol)
+                if max_amt is not None:
+                    # Balances came from the stream, not account(): this path never orders
+                    status = f"Skipped: Max {max_amt:.2f} {quote_asset} <= {min_amt:g}"
+                    resp = {"status": "skipped", "msg": status}
+                elif amt > min_amt:
                     resp = client.new_order(**params)
+                    _BAL_CACHE.clear()
                     status = "Filled/Open"
                 else:
-                    status = f"Skipped: Amt {amt:.2f} < 10 (Wallet: {wallet_usdt})"
+                    status = f"Skipped: Amt {amt:.2f} < {min_amt:g} (Wallet: {wallet_quote} {quote_asset})"
                     resp = {"status": "skipped", "msg": status}
 
         # 5. SELL LOGIC
@@ -304,29 +753,24 @@ def webhook():
 
                 if target_type == 'LIMIT':
                     raw_price = float(data.get('limit_price', sent_price))
-                    adj_price = raw_price * (1 - (j2_slip / 100.0))
-                    tick_size = get_price_tick_size(symbol)
-                    final_lim = round_step_size(adj_price, tick_size)
+                    final_lim, price_str = limit_price(symbol, 'SELL', raw_price, j2_slip)
                     params['quantity'] = qty
-                    params['price'] = "{:.8f}".format(final_lim).rstrip('0').rstrip('.')
+                    params['price'] = price_str
                     params['timeInForce'] = data.get('timeInForce', 'GTC')
                 else:
                     params['quantity'] = qty
                 
                 resp = client.new_order(**params)  
+                _BAL_CACHE.clear()
                 status = "Filled"
 
         # --- AGGREGATION & LOGGING ---
-        total_qty = 0.0
-        total_quote = 0.0
-        if 'fills' in resp:
-            for f in resp['fills']:
-                total_qty += float(f['qty'])
-                total_quote += float(f['price']) * float(f['qty'])
+        # Binance already totals the fills: VWAP = quote spent / base filled
+        total_qty = safe_float(resp.get('executedQty'))
         
         if total_qty > 0:
             exec_qty = total_qty
-            exec_price = total_quote / total_qty
+            exec_price = safe_float(resp.get('cummulativeQuoteQty')) / total_qty
         else:
             exec_qty = float(resp.get('origQty', 0))
             if status.startswith("Skipped"):
@@ -338,68 +782,68 @@ def webhook():
                     exec_price = safe_float(sent_price) if sent_price != 'Market' else 0
 
         # Current Wallet for Log (Visual Reference Only)
-        wallet_now = get_balance("USDT")
+        # Derived from the order response; nothing changed if the order was skipped
+        bals_after = bals if status.startswith("Skipped") else balances_after_order(bals, resp, base_asset, quote_asset)
+        wallet_now = bals_after.get("USDT", 0.0)
 
-        ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         applied_pct = f"{req_pct}%" if side == 'BUY' else f"{data.get('PercentAmount', 'Qty')}"
         
         # New Capital Column now simply shows "Wallet Balance"
+        market_price = price_f.result()
         row = [ts, symbol, side, applied_pct, sent_price, market_price, exec_price, exec_qty, status, reason, wallet_now]
-        LOG_QUEUE.append(('LOG', row))
+        queue_log(('LOG', row))
         
-        # H2 Update
-        try:
-            h1_val = sheet.acell('I1').value
-            if h1_val and h1_val.replace("USDT","") in symbol: 
-                new_coin_bal = get_balance(symbol.replace("USDT",""))
-                sheet.update('I2', [[new_coin_bal]])
-        except: pass
+        # H2 Update (the logger reads the real balance off the request path)
+        if BOT_MEMORY.monitor_asset == base_asset:
+            queue_log(('H2_REFRESH', base_asset))
         
-        return jsonify(resp)
+        return resp, 200
 
     except Exception as e:
-        if sheet:
-            ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            err_row = [ts, symbol, "ERROR", 0, 0, 0, 0, 0, str(e), 0, 0]
-            LOG_QUEUE.append(('LOG', err_row))
-        return jsonify({"error": str(e)}), 500
+        err_row = [ts, symbol, "ERROR", 0, 0, 0, 0, 0, str(e), 0, 0]
+        queue_log(('LOG', err_row))
+        return {"error": str(e)}, 500
 
 @app.route('/cli', methods=['POST'])
 def cli():
-    ensure_threads_running()
-    data = request.json
-    if data.get('passphrase') != WEBHOOK_PASSPHRASE: return jsonify({"error": "Unauthorized"}), 401
+    global BOT_MEMORY
+    data = read_json()
+    if not isinstance(data, dict): return json_response({"error": "Invalid JSON"}), 400
+    if data.get('passphrase') != WEBHOOK_PASSPHRASE: return json_response({"error": "Unauthorized"}), 401
     
     method = data.get('method')
     params = data.get('params', {})
     
     if method == "debug_memory":
-        return jsonify(BOT_MEMORY)
+        return json_response({**BOT_MEMORY._asdict(), "throttled": THROTTLED, "log_dropped": LOG_DROPPED})
     
     if method == "get_capital_status":
         try:
             sheet = get_sheet()
-            data = sheet.batch_get(['E2', 'G2', 'K2'])
+            data = SHEETS.call(sheet.batch_get, ['E2', 'G2', 'K2'])
             
             e2 = safe_float(data[0][0][0] if (len(data)>0 and data[0]) else 100)
             
-            BOT_MEMORY['e2_pct'] = e2
+            with MEM_WRITE_LOCK: BOT_MEMORY = BOT_MEMORY._replace(e2_pct=e2)
             
             bal = get_balance("USDT")
             # Dedicated Cap is now just Wallet Balance
-            return jsonify({
+            return json_response({
                 "dedicated_cap": bal, 
                 "reinvest_pct": e2, 
                 "wallet_balance": bal, 
                 "effective_cap": bal
             })
         except Exception as e:
-             return jsonify({"error": f"Sync Failed: {str(e)}"}), 500
+             reset_sheet()
+             return json_response({"error": f"Sync Failed: {str(e)}"}), 500
     
     if hasattr(client, method):
-        return jsonify(getattr(client, method)(**params))
+        return json_response(getattr(client, method)(**params))
     
-    return jsonify({"error": "Method not found"}), 400
+    return json_response({"error": "Method not found"}), 400
 
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    # Local runs only; deploy with `gunicorn app:app` (see gunicorn.conf.py).
+    # No reloader: it imports the module twice and doubles the background threads
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', use_reloader=False, threaded=True)
\ No newline at end of file
@@ -265,14 +265,12 @@ if __name__ == "__main__":
         if len(args) < 3: print("Usage: balance SYMBOL"); sys.exit()
         target = args[2].upper().replace("USDT","")
         res = send_request("/cli", {"method": "account"})
-        found = False
-        for a in res['balances']:
-            if a['asset'] == target:
-                print(f"\n--- BALANCE: {target} ---")
-                print(f"Free:   {a['free']}")
-                print(f"Locked: {a['locked']}")
-                found = True
-        if not found: print(f"Asset {target} not found (0.0)")
+        a = next((b for b in res['balances'] if b['asset'] == target), None)
+        if a:
+            print(f"\n--- BALANCE: {target} ---")
+            print(f"Free:   {a['free']}")
+            print(f"Locked: {a['locked']}")
+        else: print(f"Asset {target} not found (0.0)")
 
     # 6. ACCOUNT / PRICE / FALLBACK
     elif cmd == "account":
@@ -0,0 +1,20 @@
+import os
+
+# Gunicorn picks this file up automatically: `gunicorn app:app`
+# Handlers mostly wait on Binance / Google Sheets, so threads overlap that I/O.
+# Default to a single worker: BOT_MEMORY, the log queue and the background
+# threads are per-process state (extra workers only sync settings and log;
+# the dashboard lock keeps polling to one of them).
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+timeout = 30
+# Heartbeat files on tmpfs; a disk-backed /tmp can stall workers in containers
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+# Must stay off: importing app in the master would take the dashboard flock and
+# start IO_POOL there, and every forked worker would inherit both
+preload_app = False
+
+def on_starting(server):
+    if server.cfg.preload_app:
+        raise RuntimeError("preload_app is not supported: app.py starts threads and locks at import")